@@ -20,7 +20,10 @@ with open('README.md') as f:
     _readme = f.read()
 
 _mydir = os.path.abspath(os.path.dirname(sys.argv[0]))
-_requires = [r for r in open(os.path.sep.join((_mydir, 'requirements.txt')), "r").read().split('\n') if len(r) > 1]
+with open(os.path.join(_mydir, 'requirements.txt')) as f:
+    _requires = [r for r in (line.strip() for line in f.read().splitlines())
+                 if r and not r.startswith('#')]
+
 setup(
     name='kompos',
     version='0.4.5',
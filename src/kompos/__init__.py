@@ -8,15 +8,49 @@
 # OF ANY KIND, either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import os
+import shlex
+import shutil
+import sys
+from contextlib import nullcontext
 from subprocess import call
 
-from termcolor import colored
-
 __version__ = "0.4.5"
 
+# ANSI codes for the colors kompos uses, any other color is rendered by termcolor
+COLOR_CODES = {
+    'red': '\033[31m',
+    'green': '\033[32m',
+    'yellow': '\033[33m',
+    'blue': '\033[34m',
+}
+RESET_CODE = '\033[0m'
+
+
+def _color_enabled():
+    """ termcolor rules: the disabling variables win over FORCE_COLOR, then the tty decides """
+    if os.environ.get('ANSI_COLORS_DISABLED') or os.environ.get('NO_COLOR'):
+        return False
+    if os.environ.get('FORCE_COLOR'):
+        return True
+    return sys.stdout.isatty()
+
+
+COLOR_ENABLED = _color_enabled()
+
+# Characters that need a shell to be interpreted
+SHELL_METACHARACTERS = frozenset('&|;<>$`*?(){}[]~#\n')
+
 
 def display(msg, color):
-    print(colored(msg, color))
+    code = COLOR_CODES.get(color)
+    if not COLOR_ENABLED:
+        print(msg)
+    elif code is None:
+        from termcolor import colored
+        print(colored(msg, color))
+    else:
+        print(f"{code}{msg}{RESET_CODE}")
 
 
 class Executor:
@@ -34,9 +68,61 @@ class Executor:
 
     @staticmethod
     def _execute(cmd, cwd=None):
-        if 'command' in cmd:
-            shell_command = cmd['command']
-            display(shell_command, color='yellow')
-            return call(shell_command, shell=True, cwd=cwd)
-        else:
+        """
+        The command can be either a shell string or an argv list. An argv list is executed
+        directly, without a /bin/sh wrapper, in the optional cwd and env given by the command dict.
+        The optional pre_commands are run first, in order, and stop the execution on failure.
+        They are run while holding the optional pre_commands_lock.
+        """
+        shell_command = cmd.get('command')
+        if shell_command is None:
             return 1
+
+        # Nothing to run (e.g. the config runner), don't spawn a shell for it
+        if not shell_command:
+            return 0
+
+        cwd = cmd.get('cwd', cwd)
+        env = cmd.get('env')
+        pre_commands = cmd.get('pre_commands')
+        if pre_commands:
+            with cmd.get('pre_commands_lock') or nullcontext():
+                for pre_command in pre_commands:
+                    return_code = Executor._call(pre_command, cwd, env)
+                    if return_code != 0:
+                        return return_code
+
+        return Executor._call(shell_command, cwd, env)
+
+    @staticmethod
+    def _call(shell_command, cwd=None, env=None):
+        if isinstance(shell_command, (list, tuple)):
+            display(shlex.join(shell_command), color='yellow')
+            return call(shell_command, cwd=cwd, env=env)
+
+        display(shell_command, color='yellow')
+        argv = simple_argv(shell_command)
+        if argv:
+            return call(argv, cwd=cwd, env=env)
+
+        return call(shell_command, shell=True, cwd=cwd, env=env)
+
+
+def simple_argv(shell_command):
+    """
+    Split a shell command into an argv list if it can be executed without a shell: no shell
+    metacharacters, no leading variable assignment and a program that is not a shell builtin.
+    Returns None otherwise.
+    """
+    if SHELL_METACHARACTERS.intersection(shell_command):
+        return None
+
+    try:
+        argv = shlex.split(shell_command)
+    except ValueError:
+        return None
+
+    if not argv or '=' in argv[0] or shutil.which(argv[0]) is None:
+        return None
+
+    return argv
@@ -0,0 +1,63 @@
+# Copyright 2019 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Temporary files of the cache end with the pid of the process writing them
+TMP_FILE_RE = re.compile(r"\.\d+$")
+
+
+def read_json_cache(cache_file):
+    """
+    Return the dict stored in a JSON cache file, empty if missing or unreadable.
+    """
+    if not cache_file:
+        return dict()
+
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else dict()
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_json_cache(cache_file, data):
+    if cache_file:
+        write_cache_file(cache_file, lambda f: json.dump(data, f))
+
+
+def write_cache_file(cache_file, write, mode="w"):
+    """
+    Write a cache file with write(f). It is written to a temporary file first, so that concurrent
+    runs never read a partial file. The cache is an optimization only, never fail the run because
+    of it: errors are logged and ignored.
+    """
+    tmp_file = f"{cache_file}.{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+        with open(tmp_file, mode) as f:
+            write(f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logger.debug("Could not write the cache file %s", cache_file, exc_info=True)
+        remove_cache_file(tmp_file)
+
+
+def remove_cache_file(cache_file):
+    try:
+        os.remove(cache_file)
+    except OSError:
+        pass
@@ -8,16 +8,38 @@
 # OF ANY KIND, either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import hashlib
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+
 from himl.config_generator import ConfigProcessor
 
 from kompos import display
+from kompos.helpers.cache import TMP_FILE_RE, remove_cache_file, write_cache_file
+
+logger = logging.getLogger(__name__)
 
-COMPOSITION_KEY = "composition"
+# himl interpolation of an environment variable, e.g. {{env(CLUSTER)}}
+ENV_INTERPOLATION_RE = re.compile(r"\{\{\s*env\(\s*([^)\s]+)\s*\)\s*\}\}")
 
 
 class HierarchicalConfigGenerator:
-    def __init__(self):
+    def __init__(self, config_cache_dir=None):
         self.config_processor = ConfigProcessor()
+        # Rendered configs of side-effect free generate_config calls (no output file, no printing)
+        self.generated_configs = dict()
+        # When set to a list, calls writing an output file are collected here instead of being
+        # rendered, so they can be rendered later with generate_config_files
+        self.deferred_configs = None
+        # Process pool of the enclosing config_files_pool block, renders the deferred calls
+        self.config_files_executor = None
+        # Directory where generated config files are cached across runs (disabled if None)
+        self.config_cache_dir = config_cache_dir
 
     def generate_config(
             self,
@@ -38,6 +60,58 @@ class HierarchicalConfigGenerator:
             type_conflict_strategies=["override"]
     ):
 
+        if output_file and self.deferred_configs is not None:
+            self.deferred_configs.append((self.config_cache_dir, dict(
+                config_path=config_path,
+                filters=filters,
+                exclude_keys=exclude_keys,
+                enclosing_key=enclosing_key,
+                remove_enclosing_key=remove_enclosing_key,
+                output_format=output_format,
+                print_data=print_data,
+                output_file=output_file,
+                skip_interpolation_resolving=skip_interpolation_resolving,
+                skip_interpolation_validation=skip_interpolation_validation,
+                skip_secrets=skip_secrets,
+                multi_line_string=multi_line_string,
+                type_strategies=type_strategies,
+                fallback_strategies=fallback_strategies,
+                type_conflict_strategies=type_conflict_strategies,
+            )))
+            return None
+
+        # Everything that affects the rendered config, but not where it is written to
+        render_key = (
+            config_path,
+            tuple(filters),
+            tuple(exclude_keys),
+            enclosing_key,
+            remove_enclosing_key,
+            output_format,
+            skip_interpolation_resolving,
+            skip_interpolation_validation,
+            skip_secrets,
+            multi_line_string,
+            repr((type_strategies, fallback_strategies, type_conflict_strategies)),
+        )
+
+        # Only memoize calls that do not write or print the result
+        cache_key = None
+        if not output_file and not print_data:
+            cache_key = render_key + (os.stat(config_path).st_mtime_ns,)
+            if cache_key in self.generated_configs:
+                return self.generated_configs[cache_key]
+
+        # Reuse the config file rendered by a previous run if the hierarchy did not change.
+        # Only the output file is cached, so a cache hit returns None instead of the config.
+        cached_file = None
+        if output_file and self.config_cache_dir:
+            cached_file = self.get_cached_file(render_key, config_path)
+            if os.path.isfile(cached_file + ".out"):
+                logger.info("Using cached config %s for %s", cached_file, output_file)
+                self.restore_cached_file(cached_file, output_file, print_data)
+                return None
+
         cmd = self.get_sh_command(
             config_path,
             filters,
@@ -55,7 +129,7 @@ class HierarchicalConfigGenerator:
 
         display(cmd, color="yellow")
 
-        return self.config_processor.process(
+        config = self.config_processor.process(
             path=config_path,
             filters=filters,
             exclude_keys=exclude_keys,
@@ -73,6 +147,88 @@ class HierarchicalConfigGenerator:
             type_conflict_strategies=type_conflict_strategies
         )
 
+        if cache_key:
+            self.generated_configs[cache_key] = config
+
+        if cached_file:
+            self.store_cached_file(cached_file, output_file)
+
+        return config
+
+    @contextmanager
+    def parallel_config_files(self):
+        """
+        Defer the config files generated within the block and render them in parallel when it
+        exits. Nested blocks are rendered with the outermost one.
+        """
+        if self.deferred_configs is not None:
+            yield
+            return
+
+        self.deferred_configs = []
+        try:
+            yield
+            configs = self.deferred_configs
+        finally:
+            self.deferred_configs = None
+
+        generate_config_files(configs, self.config_files_executor)
+
+    @contextmanager
+    def config_files_pool(self):
+        """
+        Render the config files of all the parallel_config_files blocks within this block with a
+        single process pool, instead of starting one per block. Workers start on first use.
+        """
+        if self.config_files_executor is not None:
+            yield
+            return
+
+        with ProcessPoolExecutor() as executor:
+            self.config_files_executor = executor
+            try:
+                yield
+            finally:
+                self.config_files_executor = None
+
+    def get_cached_file(self, render_key, config_path):
+        """
+        Return the cache path prefix of a rendered config. The name ends with the latest
+        mtime of the hierarchy and a digest of the environment variables it interpolates,
+        so any change to either invalidates it.
+        """
+        digest = hashlib.blake2b(repr(render_key).encode("utf-8"), digest_size=16).hexdigest()
+        env_digest = hashlib.blake2b(repr(config_tree_env(config_path)).encode("utf-8"),
+                                     digest_size=8).hexdigest()
+        return os.path.join(self.config_cache_dir,
+                            f"{digest}-{config_tree_mtime(config_path)}-{env_digest}")
+
+    @staticmethod
+    def restore_cached_file(cached_file, output_file, print_data):
+        shutil.copyfile(cached_file + ".out", output_file)
+        if print_data:
+            with open(output_file) as f:
+                print(f.read())
+
+    def store_cached_file(self, cached_file, output_file):
+        """ Caching is best effort, a failure to store the entry never fails the run """
+        # Drop the entries of older versions of the hierarchy, but not the temporary files
+        # of runs that are still writing theirs
+        digest = os.path.basename(cached_file).split("-", 1)[0]
+        try:
+            entries = list(os.scandir(self.config_cache_dir))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.name.startswith(digest + "-") and not TMP_FILE_RE.search(entry.name):
+                remove_cache_file(entry.path)
+
+        def copy_output_file(f):
+            with open(output_file, "rb") as source:
+                shutil.copyfileobj(source, f)
+
+        write_cache_file(cached_file + ".out", copy_output_file, mode="wb")
+
     @staticmethod
     def get_sh_command(
             config_path,
@@ -89,18 +245,17 @@ class HierarchicalConfigGenerator:
             multi_line_string=False,
 
     ):
-        command = "kompos {} config --format {}".format(
-            config_path, output_format)
+        command = f"kompos {config_path} config --format {output_format}"
         for filter in filters:
-            command += " --filter {}".format(filter)
+            command += f" --filter {filter}"
         for exclude in exclude_keys:
-            command += " --exclude {}".format(exclude)
+            command += f" --exclude {exclude}"
         if enclosing_key:
-            command += " --enclosing-key {}".format(enclosing_key)
+            command += f" --enclosing-key {enclosing_key}"
         if remove_enclosing_key:
-            command += " --remove-enclosing-key {}".format(remove_enclosing_key)
+            command += f" --remove-enclosing-key {remove_enclosing_key}"
         if output_file:
-            command += " --output-file {}".format(output_file)
+            command += f" --output-file {output_file}"
         if print_data:
             command += " --print-data"
         if skip_interpolation_resolving:
@@ -113,3 +268,94 @@ class HierarchicalConfigGenerator:
             command += " --multi-line-string"
 
         return command
+
+
+def generate_config_file(deferred_config):
+    """
+    Render a deferred generate_config call. Module level so it can run in a process pool.
+    """
+    config_cache_dir, config = deferred_config
+    HierarchicalConfigGenerator(config_cache_dir).generate_config(**config)
+
+
+def config_tree_mtime(config_path):
+    """
+    Return the latest mtime (ns) of the directories in the hierarchy of config_path and of
+    the files they contain, i.e. of everything himl reads to render config_path.
+    """
+    # Compositions share their parent directories, so each directory is scanned once
+    return max(_directory_mtime(path, os.stat(path).st_mtime_ns)
+               for path in hierarchy_directories(config_path))
+
+
+def config_tree_env(config_path):
+    """
+    Return the sorted (name, value) pairs of the environment variables interpolated by the
+    files of the hierarchy of config_path.
+    """
+    names = set()
+    for path in hierarchy_directories(config_path):
+        names.update(_directory_env_names(path, _directory_mtime(path, os.stat(path).st_mtime_ns)))
+
+    return tuple((name, os.environ.get(name)) for name in sorted(names))
+
+
+def hierarchy_directories(config_path):
+    """
+    Yield config_path and its parent directories.
+    """
+    path = os.path.normpath(config_path)
+    while True:
+        yield path
+
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return
+        path = parent
+
+
+@lru_cache(maxsize=1024)
+def _directory_mtime(path, mtime):
+    """
+    Return the latest mtime (ns) of a directory and of the files it contains. Results are
+    cached for the lifetime of the process and invalidated when the directory mtime changes.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                mtime = max(mtime, entry.stat().st_mtime_ns)
+    return mtime
+
+
+@lru_cache(maxsize=1024)
+def _directory_env_names(path, mtime):
+    """
+    Return the names of the environment variables interpolated by the yaml files of a directory.
+    Compositions share their parent directories, so each directory is read once per mtime.
+    """
+    names = set()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith((".yaml", ".yml")):
+                with open(entry.path, errors="replace") as f:
+                    names.update(ENV_INTERPOLATION_RE.findall(f.read()))
+    return frozenset(names)
+
+
+def generate_config_files(configs, executor=None):
+    """
+    Render deferred generate_config calls in parallel, in the given process pool or in a new one
+    with one process per CPU. Hierarchical merging is CPU bound, so processes are used instead
+    of threads. A single call is rendered in the current process.
+    """
+    if len(configs) <= 1:
+        for config in configs:
+            generate_config_file(config)
+        return
+
+    if executor is None:
+        with ProcessPoolExecutor() as executor:
+            # Consume the results to raise the first rendering error, if any
+            list(executor.map(generate_config_file, configs))
+    else:
+        list(executor.map(generate_config_file, configs))
@@ -11,10 +11,10 @@
 import json
 import logging
 import os
+import shutil
 import subprocess
 import tempfile
 import uuid
-from distutils.dir_util import copy_tree, remove_tree
 from string import Template
 
 NIX_GIT_REPO_TEMPLATE = Template(
@@ -82,7 +82,7 @@ def nix_install(name, repo_url, version, sha256=None):
     if not sha256 or version == "master":
         expr = nix_generate_git_expr(name, version, git_drv_info(repo_url, version))
 
-    logging.info("Installing nix derivation %s-%s", name, version)
+    logger.info("Installing nix derivation %s-%s", name, version)
 
     with tempfile.TemporaryDirectory() as tmpdir:
         nix_file = os.path.join(tmpdir, "main.nix")
@@ -130,18 +130,18 @@ def writeable_nix_out_path(name):
     out_path = nix_out_path(name)
     tmp_dir = os.path.join(tempfile.gettempdir(), str(uuid.uuid1()))
 
-    logging.info("Creating writeable directory '%s'", tmp_dir)
+    logger.info("Creating writeable directory '%s'", tmp_dir)
 
     if os.path.exists(tmp_dir):
-        remove_tree(tmp_dir)
+        shutil.rmtree(tmp_dir)
 
     os.mkdir(tmp_dir)
 
-    logging.info(
+    logger.info(
         "Copying nix derivation '%s' to a writeable location '%s'", name, tmp_dir,
     )
 
-    copy_tree(out_path, tmp_dir)
+    shutil.copytree(out_path, tmp_dir, dirs_exist_ok=True)
 
     return tmp_dir
 
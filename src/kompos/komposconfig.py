@@ -10,7 +10,7 @@
 
 import logging
 import os
-from distutils.version import StrictVersion
+import re
 from functools import reduce
 
 import fastjsonschema
@@ -21,6 +21,11 @@ from kompos import __version__
 logger = logging.getLogger(__name__)
 
 CONFIG_SCHEMA_PATH = "data/config_schema.json"
+# major[.minor[.patch]] of a version string
+VERSION_RE = re.compile(r'^(\d+)(?:\.(\d+))?(?:\.(\d+))?')
+# Default directory of the generated config files cache
+DEFAULT_CONFIG_CACHE_DIR = "~/.cache/kompos"
+NIX_INSTALL_CACHE_FILENAME = "nix-installs.json"
 
 
 def get_value_or(dictionary, x_path, default=None):
@@ -33,6 +38,17 @@ def get_value_or(dictionary, x_path, default=None):
         if isinstance(d, dict) else default, keys, dictionary)
 
 
+def version_tuple(version):
+    """
+    Parse a "major[.minor[.patch]]" version into a comparable tuple, e.g. "0.4" -> (0, 4, 0).
+    """
+    match = VERSION_RE.match(version)
+    if not match:
+        raise ValueError("invalid version number '{}'".format(version))
+
+    return tuple(int(part or 0) for part in match.groups())
+
+
 class KomposConfig:
     """
     Parses all the available configuration files in order and merges them together.
@@ -47,6 +63,7 @@ class KomposConfig:
     def __init__(self, console_args, package_dir):
         self.config = dict()
         self.package_dir = package_dir
+        self._lookup_cache = dict()
         self.validate = fastjsonschema.compile(self.read_schema())
 
         paths = self.DEFAULT_PATHS[:]
@@ -90,7 +107,7 @@ class KomposConfig:
         if not min_kompos_version:
             return
 
-        if StrictVersion(__version__) < StrictVersion(min_kompos_version):
+        if version_tuple(__version__) < version_tuple(min_kompos_version):
             raise Exception(
                 "The current kompos version '{}' is lower than the minimum required version '{}'".format(
                     __version__, min_kompos_version,
@@ -113,6 +130,30 @@ class KomposConfig:
     def all(self):
         return self.config
 
+    def config_cache_dir(self, runner):
+        """
+        The directory where the config files generated for a runner are cached across runs,
+        None when disabled.
+        """
+        return self.cache_file(runner)
+
+    def nix_install_cache_file(self):
+        """
+        The file where the installed nix derivations are recorded across runs.
+        None when the config cache is disabled.
+        """
+        return self.cache_file(NIX_INSTALL_CACHE_FILENAME)
+
+    def cache_file(self, filename):
+        """
+        The path of an entry of the cache directory, None when the config cache is disabled.
+        """
+        if not get_value_or(self.config, "config_cache/enabled"):
+            return None
+
+        cache_dir = get_value_or(self.config, "config_cache/path", DEFAULT_CONFIG_CACHE_DIR)
+        return os.path.join(os.path.expanduser(cache_dir), filename)
+
     def nix(self):
         return get_value_or(self.config, "nix")
 
@@ -124,14 +165,36 @@ class KomposConfig:
             os.environ["VAULT_ROLE"] = get_value_or(self.config, "vault/svc_ldap_user_role")
             logger.info("Vault backend enabled")
 
-    def excluded_config_keys(self, composition, default=[]):
-        return get_value_or(self.config, "compositions/config_keys/excluded/{}".format(composition), default)
+    def cached_value_or(self, x_path, default=None):
+        """
+        Same as get_value_or on the merged config, but memoize the lookup since the
+        configuration does not change once it has been parsed. Lists are frozen to tuples
+        so the cached value can be shared between callers.
+        """
+        if x_path not in self._lookup_cache:
+            value = get_value_or(self.config, x_path)
+            self._lookup_cache[x_path] = tuple(value) if isinstance(value, list) else value
+
+        value = self._lookup_cache[x_path]
+        return default if value is None else value
 
-    def filtered_output_keys(self, composition, default=[]):
-        return get_value_or(self.config, "compositions/config_keys/filtered/{}".format(composition), default)
+    def excluded_config_keys(self, composition, default=()):
+        return self.cached_value_or(f"compositions/config_keys/excluded/{composition}", default)
 
-    def composition_order(self, composition, default=[]):
-        return get_value_or(self.config, "compositions/order/{}".format(composition), default)
+    def filtered_output_keys(self, composition, default=()):
+        return self.cached_value_or(f"compositions/config_keys/filtered/{composition}", default)
+
+    def composition_order(self, composition, default=()):
+        return self.cached_value_or(f"compositions/order/{composition}", default)
+
+    def composition_concurrency(self, runner, default=1):
+        return self.cached_value_or(f"compositions/concurrency/{runner}", default)
+
+    def composition_needs(self, runner, default=None):
+        return self.cached_value_or(f"compositions/needs/{runner}", default or {})
+
+    def terraform_parallelism(self, default=None):
+        return self.cached_value_or("terraform/parallelism", default)
 
     def runner_version(self, runner):
         return get_value_or(self.config, "{}/version".format(runner), 'latest')
@@ -146,4 +209,18 @@ class KomposConfig:
         return self.config[runner]['root_path']
 
     def local_path(self, runner):
-        return os.path.expanduser(self.config[runner]['local_path'])
+        key = ('local_path', runner)
+        if key not in self._lookup_cache:
+            self._lookup_cache[key] = os.path.expanduser(self.config[runner]['local_path'])
+
+        return self._lookup_cache[key]
+
+    def output_path(self, runner):
+        """
+        The default (non nix) output path of a runner: local_path joined with root_path.
+        """
+        key = ('output_path', runner)
+        if key not in self._lookup_cache:
+            self._lookup_cache[key] = os.path.join(self.local_path(runner), self.root_path(runner))
+
+        return self._lookup_cache[key]
@@ -26,11 +26,10 @@ logger = logging.getLogger(__name__)
 
 
 def configure_logging(args):
-    if args.verbose:
-        if args.verbose > 1:
-            logging.basicConfig(level=logging.DEBUG)
-        else:
-            logging.basicConfig(level=logging.INFO)
+    # Configured once here, the runners only log
+    if not logging.root.handlers:
+        debug = args.verbose and args.verbose > 1
+        logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
 
 
 class AppContainer(Container):
@@ -65,7 +64,7 @@ class AppContainer(Container):
         args, extra_args = self.root_parser.parse_known_args(self.argv)
 
         configure_logging(args)
-        logger.debug('cli args: {}, extra_args: {}'.format(args, extra_args))
+        logger.debug('cli args: %s, extra_args: %s', args, extra_args)
 
         # Bind some very useful dependencies
         self.package_dir = lambda c: os.path.dirname(__file__)
@@ -77,7 +76,7 @@ class AppContainer(Container):
         self.full_config_path = cache(lambda c: os.path.join(self.root_path, self.config_path))
 
         # change path to the root_path
-        logger.info('root path: {}'.format(self.root_path))
+        logger.info('root path: %s', self.root_path)
         os.chdir(self.root_path)
 
         return args
@@ -104,13 +103,6 @@ def get_config_path(console_args):
     return console_args.config_path
 
 
-def get_full_config_path(root_path, console_args):
-    """ Return config path + root_path if path is relative """
-    if os.path.isabs(console_args.config_path):
-        return console_args.config_path
-    return os.path.join(root_path, console_args.config_path)
-
-
 def get_root_path(args):
     """ Either the root_path option or the current working dir """
     if args.root_path:
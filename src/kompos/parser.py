@@ -9,10 +9,14 @@
 # governing permissions and limitations under the License.
 
 import argparse
+import re
 import sys
 
 from kompos import __version__
 
+# Dashes pasted from rich text (hyphens, en/em dashes, minus sign) instead of a plain '-'
+INVALID_DASH_RE = re.compile(r'[\u2010-\u2015\u2212]')
+
 
 class RootParser:
     def __init__(self, sub_parsers=None):
@@ -23,8 +27,16 @@ class RootParser:
         if sub_parsers is None:
             sub_parsers = []
         self.sub_parsers = sub_parsers
+        self.parser = None
 
     def _get_parser(self):
+        # The parser only depends on the sub parsers, build it once
+        if self.parser is None:
+            self.parser = self._build_parser()
+
+        return self.parser
+
+    def _build_parser(self):
         parser = argparse.ArgumentParser(
             description='Run commands against a definition', prog='kompos')
         parser.add_argument('config_path',
@@ -60,24 +72,22 @@ class RootParser:
 
         return parser
 
-    @staticmethod
-    def _check_args_for_unicode(args):
+    def _check_args_for_unicode(self, args):
         if args is None:
-            args = sys.argv
-        try:
-            for value in args:
-                value.encode('utf-8')
-        except UnicodeDecodeError as e:
-            print('Invalid character in argument "{0}", most likely an "en dash", replace it with normal dash -'.format(
-                e.args[1]))
-            raise
+            args = sys.argv[1:]
+        # Arguments are already unicode, only look for options typed with dashes pasted from
+        # rich text. Dashes inside values (e.g. descriptions) are legitimate.
+        for value in args:
+            if INVALID_DASH_RE.match(value):
+                self._get_parser().error('invalid character in argument "{0}", most likely an '
+                                         '"en dash", replace it with normal dash -'.format(value))
 
     def parse_args(self, args=None):
-        RootParser._check_args_for_unicode(args)
+        self._check_args_for_unicode(args)
         return self._get_parser().parse_args(args)
 
     def parse_known_args(self, args=None):
-        RootParser._check_args_for_unicode(args)
+        self._check_args_for_unicode(args)
         return self._get_parser().parse_known_args(args)
 
 
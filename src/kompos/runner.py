@@ -11,24 +11,30 @@
 import argparse
 import logging
 import os
-from subprocess import Popen, PIPE
-
-from himl import ConfigRunner
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
+from kompos.helpers.cache import read_json_cache, write_json_cache
 from kompos.helpers.himl_helper import HierarchicalConfigGenerator
-from kompos.helpers.nix import writeable_nix_out_path, is_nix_enabled, nix_install
+from kompos.helpers.nix import is_nix_enabled
 from kompos.komposconfig import get_value_or
 
 logger = logging.getLogger(__name__)
 
 COMPOSITION_KEY = "composition"
+# Matches the version in the `--version` output of a runner, e.g. "Terraform v1.3.0"
+RUNNER_VERSION_RE = re.compile(r'v?\d+(\.\d+)+\S*')
+# Seconds to wait for `<runner> --version` before giving up
+RUNNER_VERSION_TIMEOUT = 30
+# Source ([repo_url, version, sha256]) last installed by this process, by nix derivation name
+installed_nix_sources = dict()
 
 
 class GenericRunner(HierarchicalConfigGenerator):
     def __init__(self, kompos_config, full_config_path, config_path, execute, runner_type):
-        super(GenericRunner, self).__init__()
-
-        logging.basicConfig(level=logging.INFO)
+        super(GenericRunner, self).__init__(kompos_config.config_cache_dir(runner_type))
 
         self.execute = execute
 
@@ -42,6 +48,8 @@ class GenericRunner(HierarchicalConfigGenerator):
         self.reverse = False
         self.ordered_compositions = False
         self.generate_output = True
+        # Number of compositions executed in parallel
+        self.concurrency = 1
 
     def run(self, args, extra_args):
         logger.info("Runner: %s", self.runner_type)
@@ -56,21 +64,48 @@ class GenericRunner(HierarchicalConfigGenerator):
         if not self.runner_type:
             logger.error("Could not detect runner type and version.")
             exit(1)
-        if self.validate_runner:
-            validate_runner_version(self.kompos_config, self.runner_type)
+        # Probe the runner version while the compositions are discovered
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            version_check = None
+            if self.validate_runner:
+                version_check = executor.submit(validate_runner_version, self.kompos_config,
+                                                self.runner_type)
+
+            compositions, paths = self.get_compositions()
 
-        compositions, paths = self.get_compositions()
+            if version_check:
+                version_check.result()
+
+        # Catch broken compositions before any config file is generated or command is run
+        self.validate_compositions(compositions, paths)
 
         return self.run_compositions(args, extra_args, compositions, paths)
 
     def run_configuration(self, args):
         return
 
-    def get_compositions(self):
-        logging.basicConfig(level=logging.INFO)
+    def validate_compositions(self, compositions, paths):
+        """
+        Validate the needs between the compositions and the raw config of every composition.
+        The raw configs are memoized, so this does not add work to the generation that follows.
+        """
+        # Raises on circular needs
+        composition_levels(compositions, self.kompos_config.composition_needs(self.runner_type))
+
+        for composition in compositions:
+            raw_config = self.get_raw_config(paths[composition],
+                                             self.kompos_config.filtered_output_keys(composition),
+                                             self.kompos_config.excluded_config_keys(composition))
+            self.validate_raw_config(composition, raw_config)
+
+    def validate_raw_config(self, composition, raw_config):
+        return
 
+    def get_compositions(self):
         compositions, paths = discover_compositions(self.config_path)
-        if self.ordered_compositions:
+
+        # Bail out before looking up and applying the composition order
+        if compositions and self.ordered_compositions:
             composition_order = self.kompos_config.composition_order(self.runner_type)
             compositions = sorted_compositions(compositions, composition_order, self.reverse)
 
@@ -80,58 +115,120 @@ class GenericRunner(HierarchicalConfigGenerator):
 
         return compositions, paths
 
-    def get_raw_config(self, config_path, composition):
-        self.kompos_config.excluded_config_keys(composition),
-        self.kompos_config.filtered_output_keys(composition)
-
+    def get_raw_config(self, config_path, filtered_keys, excluded_keys):
         return self.generate_config(
             config_path=config_path,
-            exclude_keys=self.kompos_config.excluded_config_keys(composition),
-            filters=self.kompos_config.filtered_output_keys(composition),
+            exclude_keys=excluded_keys,
+            filters=filtered_keys,
             skip_interpolation_validation=True,
             skip_secrets=True
         )
 
     def run_compositions(self, args, extra_args, compositions, paths):
-        for composition in compositions:
-            logger.info("Running composition: %s", composition)
+        # Reverse ordered runs (e.g. delete/destroy) are always sequential
+        if self.concurrency > 1 and not self.reverse:
+            return self.run_compositions_concurrently(args, extra_args, compositions, paths)
+
+        # The config files of each composition are rendered with one process pool for the whole run
+        with self.config_files_pool():
+            for composition in compositions:
+                # Execute runner
+                return_code = self.execute(
+                    self.prepare_composition(args, extra_args, composition, paths[composition]))
+                if return_code != 0:
+                    logger.error(
+                        "Command finished with nonzero exit code for composition '%s'."
+                        "Will skip remaining compositions.", composition
+                    )
+                    return return_code
+
+                # Run some code after execution
+                self.execution_post_action(composition)
 
-            # Set current path
-            config_path = paths[composition]
+        return 0
 
-            # Raw config generation
-            raw_config = self.get_raw_config(config_path, composition)
+    def run_compositions_concurrently(self, args, extra_args, compositions, paths):
+        """
+        Generate the configuration of every composition first (config files are rendered in a
+        process pool), then execute the compositions with a pool of self.concurrency workers.
+        Pending compositions are cancelled on the first failure.
+        """
+        if not compositions:
+            return 0
+
+        # Collect the config files of all compositions and render them in parallel
+        with self.parallel_config_files():
+            configurations = {
+                composition: self.configure_composition(args, composition, paths[composition])
+                for composition in compositions
+            }
+
+        # Build the commands once the config files exist
+        commands = dict()
+        for composition, (default_output_path, raw_config) in configurations.items():
+            commands[composition] = self.execution(args, extra_args, default_output_path,
+                                                   composition, raw_config)
+
+        # Compositions only wait for the compositions they need, level by level
+        needs = self.kompos_config.composition_needs(self.runner_type)
+        levels = composition_levels(compositions, needs)
+
+        # Threads only wait on the runner subprocesses, start at most one per composition
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(commands))) as executor:
+            for level in levels:
+                futures = {executor.submit(self.execute, commands[composition]): composition
+                           for composition in level}
+                for future in as_completed(futures):
+                    return_code = future.result()
+                    if return_code != 0:
+                        logger.error(
+                            "Command finished with nonzero exit code for composition '%s'."
+                            "Will skip remaining compositions.", futures[future]
+                        )
+                        for pending in futures:
+                            pending.cancel()
+                        return return_code
+
+                    self.execution_post_action(futures[future])
 
-            # Generate output paths for configs
-            default_output_path = None
-            if self.generate_output:
-                default_output_path = get_default_output_path(args, raw_config, self.kompos_config, self.runner_type)
+        return 0
 
-            # Set default key filters
-            filtered_keys = self.kompos_config.filtered_output_keys(composition)
-            excluded_keys = self.kompos_config.excluded_config_keys(composition)
+    def prepare_composition(self, args, extra_args, composition, config_path):
+        """
+        Generate the configuration of a composition and return the command that runs it.
+        """
+        default_output_path, raw_config = self.configure_composition(args, composition,
+                                                                     config_path)
+        return self.execution(args, extra_args, default_output_path, composition, raw_config)
 
-            if self.himl_args.exclude:
-                filtered_keys = self.kompos_config.filtered_output_keys(composition) + self.himl_args.filter
-                excluded_keys = self.kompos_config.excluded_config_keys(composition) + self.himl_args.exclude
+    def configure_composition(self, args, composition, config_path):
+        """
+        Generate the configuration of a composition, return its output path and raw config.
+        """
+        logger.info("Running composition: %s", composition)
 
-            # Runner pre-configuration
-            self.execution_configuration(composition, config_path, default_output_path, raw_config,
-                                         filtered_keys, excluded_keys)
+        # Composition key filters, looked up once per composition
+        filtered_keys = self.kompos_config.filtered_output_keys(composition)
+        excluded_keys = self.kompos_config.excluded_config_keys(composition)
 
-            # Execute runner
-            return_code = self.execute(self.execution(args, extra_args, default_output_path, composition, raw_config))
-            if return_code != 0:
-                logger.error(
-                    "Command finished with nonzero exit code for composition '%s'."
-                    "Will skip remaining compositions.", composition
-                )
-                return return_code
+        # Raw config generation
+        raw_config = self.get_raw_config(config_path, filtered_keys, excluded_keys)
 
-            # Run some code after execution
-            self.execution_post_action()
+        # Generate output paths for configs
+        default_output_path = None
+        if self.generate_output:
+            default_output_path = get_default_output_path(args, raw_config, self.kompos_config,
+                                                          self.runner_type)
 
-        return 0
+        # Extend the default key filters with the himl arguments, dropping duplicates
+        filtered_keys = unique_keys(filtered_keys, self.himl_args.filter)
+        excluded_keys = unique_keys(excluded_keys, self.himl_args.exclude)
+
+        # Runner pre-configuration
+        self.execution_configuration(composition, config_path, default_output_path, raw_config,
+                                     filtered_keys, excluded_keys)
+
+        return default_output_path, raw_config
 
     def execution_configuration(self, composition, config_path, default_output_path, raw_config,
                                 filtered_keys, excluded_keys):
@@ -139,64 +236,131 @@ class GenericRunner(HierarchicalConfigGenerator):
 
     @staticmethod
     def execution(args, extra_args, default_output_path, composition, raw_config):
+        """
+        Return the command dict handed to the Executor:
+            command: an argv list, executed without a shell, or a shell string
+            cwd: optional working directory of the command
+            env: optional environment of the command
+            pre_commands: optional commands to run before, e.g. an init step
+            pre_commands_lock: optional lock held while running the pre_commands
+        """
         return
 
     @staticmethod
-    def execution_post_action():
+    def execution_post_action(composition):
         return
 
 
 def discover_compositions(config_path):
-    path_params = dict(split_path(x) for x in config_path.split('/'))
+    """
+    Discover the compositions under config_path. Results are cached for the lifetime of
+    the process and invalidated when the directory mtime changes.
+    """
+    compositions, paths = _discover_compositions(config_path, os.stat(config_path).st_mtime_ns)
+    return list(compositions), dict(paths)
 
-    composition_type = path_params.get(COMPOSITION_KEY, None)
+
+@lru_cache(maxsize=128)
+def _discover_compositions(config_path, mtime):
+    composition_type = path_param(config_path, COMPOSITION_KEY)
     if not composition_type:
         raise Exception("No composition detected in path.")
 
     # Check if single composition selected
-    composition = path_params.get(composition_type, None)
+    composition = path_param(config_path, composition_type)
     if composition:
-        return [composition], {composition: config_path}
+        return (composition,), ((composition, config_path),)
 
     # Discover composition paths
     paths = dict()
     compositions = []
-    for subpath in os.listdir(config_path):
-        if composition_type + "=" in subpath:
-            composition = split_path(subpath)[1]
-            paths[composition] = os.path.join(config_path, "{}={}".format(composition_type, composition))
-            compositions.append(composition)
+    composition_prefix = composition_type + "="
+    with os.scandir(config_path) as entries:
+        for entry in entries:
+            if entry.name.startswith(composition_prefix) and entry.is_dir():
+                composition = entry.name[len(composition_prefix):]
+                paths[composition] = entry.path
+                compositions.append(composition)
 
-    return compositions, paths
+    return tuple(compositions), tuple(paths.items())
 
 
 def sorted_compositions(compositions, composition_order, reverse=False):
+    result = _sorted_compositions(tuple(compositions), tuple(composition_order), reverse)
+    return result if reverse else list(result)
+
+
+@lru_cache(maxsize=128)
+def _sorted_compositions(compositions, composition_order, reverse):
     result = list(filter(lambda x: x in compositions, composition_order))
-    return tuple(reversed(result)) if reverse else result
+    return tuple(reversed(result)) if reverse else tuple(result)
+
 
+def composition_levels(compositions, needs):
+    """
+    Group the compositions in levels that can run in parallel: a composition only needs
+    compositions of the previous levels. Needs on compositions that are not part of the run
+    are ignored. Without needs, all the compositions are in a single level.
+    """
+    selected = set(compositions)
+    remaining = list(compositions)
+    done = set()
+    levels = []
+
+    while remaining:
+        level = tuple(c for c in remaining
+                      if done.issuperset(selected.intersection(needs.get(c, ()))))
+        if not level:
+            raise Exception("Circular needs between compositions: {}".format(", ".join(remaining)))
+
+        levels.append(level)
+        done.update(level)
+        remaining = [c for c in remaining if c not in done]
 
-def split_path(value, separator='='):
-    if separator in value:
-        return value.split(separator)
-    return [value, ""]
+    return levels
+
+
+def unique_keys(keys, extra_keys=None):
+    """
+    Merge two key lists into an order preserving tuple without duplicates.
+    """
+    return tuple(dict.fromkeys((*keys, *(extra_keys or ()))))
+
+
+def path_param(path, key):
+    """
+    Return the value of the last `key=value` segment of a config path, None if there is none.
+    """
+    marker = key + '='
+    start = path.rfind('/' + marker)
+    if start != -1:
+        start += 1
+    elif path.startswith(marker):
+        start = 0
+    else:
+        return None
+
+    start += len(marker)
+    end = path.find('/', start)
+    return path[start:] if end == -1 else path[start:end]
 
 
 def get_default_output_path(args, raw_config, kompos_config, runner):
     # Use the default local repo (not versioned).
-    path = os.path.join(
-        kompos_config.local_path(runner),
-        kompos_config.root_path(runner),
-    )
+    path = kompos_config.output_path(runner)
 
     # Overwrite with the nix output, if the nix integration is enabled.
     if is_nix_enabled(args, kompos_config.nix()):
-        pname = kompos_config.repo_name()
+        from kompos.helpers.nix import writeable_nix_out_path
 
-        nix_install(
+        pname = kompos_config.repo_name(runner)
+
+        install_nix_repo(
             pname,
             kompos_config.repo_url(runner),
-            get_value_or(raw_config, 'infrastructure/{}/version', 'master'.format(runner)),
-            get_value_or(raw_config, 'infrastructure/{}/sha256'.format(runner)),
+            get_value_or(raw_config, f'infrastructure/{runner}/version', 'master'),
+            get_value_or(raw_config, f'infrastructure/{runner}/sha256'),
+            kompos_config.nix_install_cache_file(),
         )
 
         # Nix store is read-only, and terraform doesn't work properly outside
@@ -215,24 +379,51 @@ def get_default_output_path(args, raw_config, kompos_config, runner):
     return path
 
 
+def install_nix_repo(pname, repo_url, version, sha256, cache_file):
+    """
+    Install a repo version with nix, unless it is already the version installed under pname,
+    by this process or by a previous run. nix-env keeps a single version per derivation name,
+    so a composition pinned to another version replaces it.
+    """
+    from kompos.helpers.nix import nix_install, nix_out_path
+
+    source = [repo_url, version, sha256]
+    # Unpinned versions (master or no sha256) can move, always reinstall them
+    pinned = bool(sha256) and version != "master"
+    if pinned and installed_nix_sources.get(pname) == source:
+        return
+
+    installs = read_json_cache(cache_file)
+    if installs.get(pname, [None])[:-1] == source:
+        try:
+            if nix_out_path(pname) == installs[pname][-1]:
+                logger.info("Nix derivation %s-%s is already installed", pname, version)
+                installed_nix_sources[pname] = source
+                return
+        except Exception:
+            logger.debug("Could not query nix derivation %s", pname, exc_info=True)
+
+    nix_install(pname, repo_url, version, sha256)
+    installed_nix_sources[pname] = source
+
+    if pinned and cache_file:
+        installs[pname] = source + [nix_out_path(pname)]
+        write_json_cache(cache_file, installs)
+
+
 def validate_runner_version(kompos_config, runner):
     """
     Check if runner binary version is compatible with the
     version specified by the kompos configuration.
     """
     try:
-        execution = Popen([runner, '--version'],
-                          stdin=PIPE,
-                          stdout=PIPE,
-                          stderr=PIPE)
+        current_version = get_runner_version(runner)
     except Exception:
-        logging.exception("Runner {} does not appear to be installed, "
-                          "please ensure terraform is in your PATH".format(runner))
+        logger.exception("Runner %s does not appear to be installed, please ensure %s is in "
+                         "your PATH", runner, runner)
         exit(1)
 
     expected_version = kompos_config.runner_version(runner)
-    current_version, execution_error = execution.communicate()
-    current_version = current_version.decode('utf-8').split('\n', 1)[0]
 
     if expected_version not in current_version:
         raise Exception("Runner [{}] should be {}, but you have {}. Please change your version.".format(
@@ -241,12 +432,47 @@ def validate_runner_version(kompos_config, runner):
     return
 
 
-def get_himl_args(args):
-    parser = ConfigRunner.get_parser(argparse.ArgumentParser())
+def get_runner_version(runner):
+    """
+    Return the version of `<runner> --version`. The output is only cached for the lifetime of
+    the process: version managers (tfenv, asdf, mise) switch versions behind an unchanged shim,
+    so nothing about the binary on the PATH tells whether a version cached by a previous run
+    is still valid.
+    """
+    runner_path = shutil.which(runner)
+    if runner_path is None:
+        raise FileNotFoundError("{} not found in PATH".format(runner))
+
+    return _get_runner_version(runner_path)
+
+
+@lru_cache(maxsize=8)
+def _get_runner_version(runner_path):
+    from subprocess import DEVNULL, run
+    execution = run([runner_path, '--version'], stdin=DEVNULL, capture_output=True, text=True,
+                    timeout=RUNNER_VERSION_TIMEOUT)
+    first_line = execution.stdout.partition('\n')[0]
+
+    match = RUNNER_VERSION_RE.search(first_line)
+    return match.group(0) if match else first_line.strip()
+
 
+def get_himl_args(args):
+    himl_args = parse_himl_args(args.himl_args or '')
     if args.himl_args:
-        himl_args = parser.parse_args(args.himl_args.split())
         logger.info("Extra himl arguments: %s", himl_args)
-        return himl_args
-    else:
-        return parser.parse_args([])
+    return himl_args
+
+
+@lru_cache(maxsize=16)
+def parse_himl_args(himl_args):
+    """
+    Parse the --himl arguments with the himl config parser, built once per process.
+    """
+    return himl_parser().parse_args(himl_args.split())
+
+
+@lru_cache(maxsize=1)
+def himl_parser():
+    from himl import ConfigRunner
+    return ConfigRunner.get_parser(argparse.ArgumentParser())
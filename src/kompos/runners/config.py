@@ -10,8 +10,6 @@
 
 import logging
 
-from himl import ConfigRunner
-
 from kompos.parser import SubParserConfig
 from kompos.runner import GenericRunner
 
@@ -28,6 +26,7 @@ class ConfigRenderParserConfig(SubParserConfig):
         return 'Generate configurations based on a hierarchical structure, with templating support'
 
     def configure(self, parser):
+        from himl import ConfigRunner
         ConfigRunner().get_parser(parser)
 
     def get_epilog(self):
@@ -8,11 +8,14 @@
 # OF ANY KIND, either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import hashlib
+import json
 import logging
 import os
+import pathlib
 import sys
-
-from kubeconfig import KubeConfig
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from kompos.parser import SubParserConfig
 from kompos.runner import GenericRunner
@@ -23,6 +26,16 @@ RUNNER_TYPE = "helmfile"
 RUNNER_REVERSE_COMPOSITION_CMD = "delete"
 # The filename of the generated hierarchical configuration for Helmfile.
 HELMFILE_VARIABLES_FILENAME = "generated-values.yaml"
+# Helmfile subcommands that do not change the cluster, the compositions can run in parallel
+SUBCMDS_CONCURRENT = frozenset([
+    'build',
+    'diff',
+    'lint',
+    'list',
+    'status',
+    'template',
+    'write-values'
+])
 
 
 class HelmfileParser(SubParserConfig):
@@ -34,6 +47,15 @@ class HelmfileParser(SubParserConfig):
 
     def configure(self, parser):
         parser.add_argument('subcommand', help='One of the helmfile commands', type=str)
+        parser.add_argument('--compositions-concurrency',
+                            type=int,
+                            default=None,
+                            help='Number of compositions to run in parallel (default: '
+                                 'compositions.concurrency.helmfile from the kompos config, or '
+                                 '1 - sequential). Other subcommands than {} only run in '
+                                 'parallel when compositions.needs.helmfile is set, otherwise '
+                                 'they follow compositions.order'.format(
+                                     ', '.join(sorted(SUBCMDS_CONCURRENT))))
 
         return parser
 
@@ -48,85 +70,202 @@ class HelmfileParser(SubParserConfig):
             kompos data/env=dev/region=va6/project=ee/cluster=experiments/composition=helmfile helmfile --selector chart=nginx-controller sync
             # Run helmfile sync with concurrency flag
             kompos data/env=dev/region=va6/project=ee/cluster=experiments/composition=helmfile helmfile --selector chart=nginx-controller sync --concurrency=1
+            # Run helmfile diff on up to 4 compositions in parallel
+            kompos data/env=dev/composition=helmfile helmfile --compositions-concurrency=4 diff
         '''
 
 
 class HelmfileRunner(GenericRunner):
     def __init__(self, kompos_config, full_config_path, config_path, execute):
         super(HelmfileRunner, self).__init__(kompos_config, full_config_path, config_path, execute, RUNNER_TYPE)
+        # (kubeconfig file, kube context) of each composition, passed to helmfile through its
+        # environment and --kube-context, so that compositions never share a current-context
+        self.kube_configs = dict()
+        # helmfile directory of each composition
+        self.composition_paths = dict()
+        # Resolved (kubeconfig path, context) of the k8s clusters by cluster config signature
+        self.k8s_kube_configs = dict()
+        # Generated kubeconfig files by (cluster name, aws profile, region)
+        self.eks_kube_configs = dict()
+        # Temporary directory of the generated kubeconfig files, created on first use
+        self.tmp_dir = None
+        # Echo the generated values files, only in verbose mode
+        self.print_config = False
+        # Guards the kubeconfig caches above, setup_kube_config runs on worker threads
+        self.kube_config_lock = threading.Lock()
 
     def run_configuration(self, args):
         self.ordered_compositions = True
         self.reverse = (RUNNER_REVERSE_COMPOSITION_CMD == args.subcommand)
+        # Without needs, only compositions.order tells which compositions depend on each other
+        # (e.g. CRDs before apps), so commands changing the cluster run one composition at a time
+        needs = self.kompos_config.composition_needs(RUNNER_TYPE)
+        if args.subcommand in SUBCMDS_CONCURRENT or needs:
+            self.concurrency = (args.compositions_concurrency or
+                                self.kompos_config.composition_concurrency(RUNNER_TYPE))
+        self.print_config = bool(args.verbose)
 
     def execution_configuration(self, composition, config_path, default_output_path, raw_config,
                                 filtered_keys, excluded_keys):
 
-        self.setup_kube_config(raw_config)
+        # The kube config setup (possibly an EKS API call) does not depend on the
+        # generated values file, so overlap it with the config generation.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            kube_config = executor.submit(self.setup_kube_config, raw_config)
+
+            helmfile_composition_path = os.path.join(default_output_path, composition)
+            self.composition_paths[composition] = helmfile_composition_path
 
-        output_file = os.path.join(default_output_path, composition, HELMFILE_VARIABLES_FILENAME)
-        logger.info('Generating helmfiles variables file %s', output_file)
+            output_file = os.path.join(helmfile_composition_path, HELMFILE_VARIABLES_FILENAME)
+            logger.info('Generating helmfiles variables file %s', output_file)
 
-        self.generate_config(config_path=config_path,
-                             filters=filtered_keys,
-                             exclude_keys=excluded_keys,
-                             output_format="yaml",
-                             output_file=output_file,
-                             print_data=True)
+            self.generate_config(config_path=config_path,
+                                 filters=filtered_keys,
+                                 exclude_keys=excluded_keys,
+                                 output_format="yaml",
+                                 output_file=output_file,
+                                 print_data=self.print_config)
 
-    @staticmethod
-    def execution(args, extra_args, default_output_path, composition, raw_config):
-        helmfile_composition_path = os.path.join(default_output_path, composition)
+            self.kube_configs[composition] = kube_config.result()
 
-        cmd = "cd {helmfile_path} && helmfile {subcommand} {extra_args}".format(
-            helmfile_path=helmfile_composition_path,
-            subcommand=args.subcommand,
-            extra_args=' '.join(extra_args), )
+    def execution(self, args, extra_args, default_output_path, composition, raw_config):
+        kube_config_path, kube_context = self.kube_configs[composition]
+        kube_context_args = ["--kube-context", kube_context] if kube_context else []
 
-        return dict(command=cmd)
+        return dict(command=["helmfile"] + kube_context_args + [args.subcommand] + extra_args,
+                    cwd=self.composition_paths[composition],
+                    env=dict(os.environ, KUBECONFIG=kube_config_path))
 
     def setup_kube_config(self, data):
-        if data['helm']['global']['cluster']['type'] == 'k8s':
-            if all(k in data['helm']['global']['cluster']['kubeconfig'] for k in ("path", "context")):
-                if os.path.isfile(data['helm']['global']['cluster']['kubeconfig']['path']):
-                    logger.info('Using kubeconfig file: %s', data['helm']['global']['cluster']['kubeconfig']['path'])
-                else:
-                    logger.warning('kubeconfig file not found: %s',
-                                   data['helm']['global']['cluster']['kubeconfig']['path'])
-                    sys.exit(1)
-
-                kubeconfig_abs_path = os.path.abspath(data['helm']['global']['cluster']['kubeconfig']['path'])
-                conf = KubeConfig(kubeconfig_abs_path)
-                conf.use_context(data['helm']['global']['cluster']['kubeconfig']['context'])
-                os.environ['KUBECONFIG'] = kubeconfig_abs_path
-                logger.info('Current context: %s', conf.current_context())
-            else:
+        """
+        Prepare the kubeconfig of the cluster defined in the hierarchical config and return its
+        (path, context). The context is None when the kubeconfig current-context must be used.
+        The kubeconfig files of k8s clusters are never modified, since compositions running in
+        parallel may use different contexts of the same file.
+        """
+        helm_global = data['helm']['global']
+        cluster = helm_global['cluster']
+        cluster_type = cluster['type']
+
+        if cluster_type == 'k8s':
+            # Compositions of the same cluster share the kubeconfig, only resolve it once
+            signature = cluster_signature(cluster)
+            with self.kube_config_lock:
+                if signature in self.k8s_kube_configs:
+                    return self.k8s_kube_configs[signature]
+
+            kubeconfig = cluster.get('kubeconfig') or {}
+            path = kubeconfig.get('path')
+            context = kubeconfig.get('context')
+            if not (path and context):
                 logger.warning('path or context keys not found in helm.global.cluster.kubeconfig')
                 sys.exit(1)
 
-        elif data['helm']['global']['cluster']['type'] == 'eks':
-            cluster_name = data['helm']['global']['fqdn']
-            aws_profile = data['helm']['global']['aws']['profile']
-            region = data['helm']['global']['region']['location']
-            file_location = self.generate_eks_kube_config(cluster_name, aws_profile, region)
-            os.environ['KUBECONFIG'] = file_location
+            try:
+                kubeconfig_abs_path = str(pathlib.Path(path).resolve(strict=True))
+            except OSError:
+                logger.warning('kubeconfig file not found: %s', path)
+                sys.exit(1)
+            logger.info('Using kubeconfig file: %s with context: %s', path, context)
+
+            with self.kube_config_lock:
+                self.k8s_kube_configs[signature] = (kubeconfig_abs_path, context)
+            return kubeconfig_abs_path, context
+
+        elif cluster_type == 'eks':
+            cluster_name = helm_global['fqdn']
+            aws_profile = helm_global['aws']['profile']
+            region = helm_global['region']['location']
+            # The generated kubeconfig only holds this cluster, its current-context is right
+            with self.kube_config_lock:
+                return self.generate_eks_kube_config(cluster_name, aws_profile, region), None
 
         else:
             logger.warning('cluster type must be k8s or eks')
             sys.exit(1)
 
     def generate_eks_kube_config(self, cluster_name, aws_profile, region):
+        # Compositions of the same cluster reuse the kubeconfig generated for the first one
+        eks_cluster = (cluster_name, aws_profile, region)
+        if eks_cluster in self.eks_kube_configs:
+            return self.eks_kube_configs[eks_cluster]
+
+        import boto3
+        import yaml
+
         file_location = self.get_tmp_file()
-        cmd = "aws eks update-kubeconfig --name {} --profile {} --region {} --kubeconfig {}".format(
-            cluster_name, aws_profile, region, file_location)
+        try:
+            session = boto3.Session(profile_name=aws_profile, region_name=region)
+            cluster = session.client('eks').describe_cluster(name=cluster_name)['cluster']
+        except Exception as e:
+            raise Exception(f"Unable to generate EKS kube config. {e}") from e
 
-        return_code = self.execute(dict(command=cmd))
-        if return_code != 0:
-            raise Exception("Unable to generate EKS kube config. Exit code was {}".format(return_code))
+        with open(file_location, 'w') as f:
+            yaml.safe_dump(eks_kube_config(cluster, aws_profile, region), f,
+                           default_flow_style=False)
+
+        logger.info('Generated EKS kubeconfig for %s in %s', cluster_name, file_location)
+        self.eks_kube_configs[eks_cluster] = file_location
         return file_location
 
-    @staticmethod
-    def get_tmp_file():
+    def get_tmp_file(self):
+        """
+        Return a new file path in the runner temporary directory, removed when kompos exits.
+        """
         import tempfile
-        with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-            return tmp_file.name
+
+        if self.tmp_dir is None:
+            import atexit
+
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix='kompos-')
+            atexit.register(self.tmp_dir.cleanup)
+
+        fd, path = tempfile.mkstemp(prefix='kubeconfig-', suffix='.yaml', dir=self.tmp_dir.name)
+        os.close(fd)
+        return path
+
+
+def cluster_signature(cluster):
+    """
+    Return a digest of the helm.global.cluster config, equal for compositions of the same cluster.
+    """
+    data = json.dumps(cluster, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def eks_kube_config(cluster, aws_profile, region):
+    """
+    Build the same kubeconfig that `aws eks update-kubeconfig` would write for
+    an EKS describe_cluster response. Tokens are still issued by `aws eks get-token`.
+    """
+    arn = cluster['arn']
+
+    return {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{
+            'name': arn,
+            'cluster': {
+                'server': cluster['endpoint'],
+                'certificate-authority-data': cluster['certificateAuthority']['data'],
+            },
+        }],
+        'contexts': [{
+            'name': arn,
+            'context': {'cluster': arn, 'user': arn},
+        }],
+        'current-context': arn,
+        'preferences': {},
+        'users': [{
+            'name': arn,
+            'user': {
+                'exec': {
+                    'apiVersion': 'client.authentication.k8s.io/v1beta1',
+                    'command': 'aws',
+                    'args': ['--region', region, 'eks', 'get-token',
+                             '--cluster-name', cluster['name'], '--output', 'json'],
+                    'env': [{'name': 'AWS_PROFILE', 'value': aws_profile}],
+                },
+            },
+        }],
+    }
@@ -8,31 +8,53 @@
 # OF ANY KIND, either express or implied. See the License for the specific language
 # governing permissions and limitations under the License.
 
+import hashlib
+import json
 import logging
 import os
+import shutil
+import threading
 from pathlib import Path
 
+from kompos.komposconfig import get_value_or
 from kompos.parser import SubParserConfig
 from kompos.runner import GenericRunner
 
 logger = logging.getLogger(__name__)
 
 # Terraform subcommands that will need re-initialization
-SUBCMDS_WITH_INIT = [
+SUBCMDS_WITH_INIT = frozenset([
     'plan',
     'apply',
     'destroy',
     'import',
     'state'
-]
+])
 
 # Terraform subcommands that use the variables file.
-SUBCMDS_WITH_VARS = [
+SUBCMDS_WITH_VARS = frozenset([
     'plan',
     'apply',
     'destroy',
     'import'
-]
+])
+
+# Terraform subcommands that walk the resource graph and accept -parallelism
+SUBCMDS_WITH_PARALLELISM = frozenset([
+    'plan',
+    'apply',
+    'destroy',
+    'refresh'
+])
+
+# Terraform subcommands that do not change the infrastructure, the compositions can run in parallel
+SUBCMDS_CONCURRENT = frozenset([
+    'plan',
+    'validate',
+    'output',
+    'show',
+    'refresh'
+])
 
 RUNNER_TYPE = "terraform"
 RUNNER_REVERSE_COMPOSITION_CMD = "destroy"
@@ -40,6 +62,8 @@ RUNNER_REVERSE_COMPOSITION_CMD = "destroy"
 TERRAFORM_CONFIG_FILENAME = "variables.tfvars.json"
 # The filename of the generated Terrraform provider.
 TERRAFORM_PROVIDER_FILENAME = "provider.tf.json"
+# Digest of the files terraform init depends on, stored in .terraform after a successful run
+TERRAFORM_INIT_HASH_FILENAME = ".kompos_init_hash"
 # Directory to store terraform plugin cache
 TERRAFORM_CACHE_DIR = "~/.kompos/.terraform.d/plugin-cache"
 
@@ -53,6 +77,24 @@ class TerraformParser(SubParserConfig):
 
     def configure(self, parser):
         parser.add_argument('subcommand', help='One of the terraform commands', type=str)
+        parser.add_argument('--parallelism',
+                            type=int,
+                            default=None,
+                            help='Number of concurrent terraform operations (default: '
+                                 'terraform.parallelism from the kompos config, or the terraform '
+                                 'default)')
+        parser.add_argument('--compositions-concurrency',
+                            type=int,
+                            default=None,
+                            help='Number of compositions to run in parallel for {} (default: '
+                                 'compositions.concurrency.terraform from the kompos config, or '
+                                 '1 - sequential)'.format(', '.join(sorted(SUBCMDS_CONCURRENT))))
+        parser.add_argument('--force-init',
+                            action='store_true',
+                            help='Always run terraform init, even if the terraform files of the '
+                                 'composition and of its local modules did not change since the '
+                                 'last successful run. Needed to pick up new versions of remote '
+                                 'modules or providers matching the existing constraints')
 
         return parser
 
@@ -63,28 +105,69 @@ class TerraformParser(SubParserConfig):
             kompos data/env=dev/region=va6/project=ee/cluster=experiments/composition=terraform terraform plan 
             # Run helmfile sync on a single composition
             kompos data/env=dev/region=va6/project=ee/cluster=experiments/composition=terraform/terraform=myterraformcomposition terraform plan
+            # Run terraform plan with 30 concurrent operations
+            kompos data/env=dev/composition=terraform terraform --parallelism=30 plan
+            # Run terraform plan on up to 4 compositions in parallel
+            kompos data/env=dev/composition=terraform terraform --compositions-concurrency=4 plan
         '''
 
 
 class TerraformRunner(GenericRunner):
     def __init__(self, kompos_config, full_config_path, config_path, execute):
         super(TerraformRunner, self).__init__(kompos_config, full_config_path, config_path, execute, RUNNER_TYPE)
+        # terraform -parallelism, None keeps the terraform default
+        self.parallelism = None
+        # Whether the .terraform directory of the compositions is removed before running them
+        self.remove_local_cache = False
+        # terraform directory of each composition
+        self.composition_paths = dict()
+        # Whether terraform init also runs for compositions that are already initialized
+        self.force_init = False
+        # Compositions initialized by this run, their init hash is stored once they succeed
+        self.initialized_compositions = set()
+        # Shared provider plugin cache, created once
+        self.plugin_cache_dir = None
+        # The plugin cache is not safe for concurrent use, terraform init runs one at a time
+        self.init_lock = threading.Lock()
 
     def run_configuration(self, args):
         self.ordered_compositions = True
         self.reverse = (RUNNER_REVERSE_COMPOSITION_CMD == args.subcommand)
+        self.parallelism = args.parallelism or self.kompos_config.terraform_parallelism()
+        self.remove_local_cache = args.subcommand in SUBCMDS_WITH_INIT
+        self.force_init = args.force_init
+        self.plugin_cache_dir = local_config_dir()
+        # Commands changing the infrastructure always run one composition at a time
+        if args.subcommand in SUBCMDS_CONCURRENT:
+            self.concurrency = (args.compositions_concurrency or
+                                self.kompos_config.composition_concurrency(RUNNER_TYPE))
+
+    def validate_raw_config(self, composition, raw_config):
+        if not get_value_or(raw_config, "cloud/type"):
+            raise Exception(
+                "Missing cloud.type in the configuration of composition {}.".format(composition))
 
     def execution_configuration(self, composition, config_path, default_output_path, raw_config,
                                 filtered_keys, excluded_keys):
+        # Add cloud subpath for TF modules
+        terraform_composition_path = os.path.join(default_output_path, raw_config["cloud"]["type"], composition)
+        self.composition_paths[composition] = terraform_composition_path
+
+        # The provider and the variables are independent, render them in parallel
+        with self.parallel_config_files():
+            self.generate_terraform_configs(terraform_composition_path, config_path,
+                                            filtered_keys, excluded_keys)
+
+    def generate_terraform_configs(self, terraform_composition_path, config_path, filtered_keys,
+                                   excluded_keys):
         # Generate provider with subpath for cloud specific modules
         # ./terraform/compositions/aws/provider.tf.json
-        provider_path = os.path.join(default_output_path, raw_config["cloud"]["type"], composition,
-                                     TERRAFORM_PROVIDER_FILENAME)
+        provider_path = os.path.join(terraform_composition_path, TERRAFORM_PROVIDER_FILENAME)
         logger.info('Generating terraform provider %s', provider_path)
         self.generate_config(
             config_path=config_path,
             exclude_keys=excluded_keys,
-            filters=filtered_keys + ["provider", "terraform"],
+            filters=filtered_keys + ("provider", "terraform"),
             output_format="json",
             output_file=provider_path,
             print_data=True,
@@ -94,54 +177,131 @@ class TerraformRunner(GenericRunner):
         )
 
         # Generate variables with subpath for cloud specific modules
-        variables_path = os.path.join(default_output_path, raw_config["cloud"]["type"], composition,
-                                      TERRAFORM_CONFIG_FILENAME)
+        variables_path = os.path.join(terraform_composition_path, TERRAFORM_CONFIG_FILENAME)
         logger.info('Generating terraform variables %s', variables_path)
         self.generate_config(
             config_path=config_path,
-            exclude_keys=excluded_keys + ["provider"],
+            exclude_keys=excluded_keys + ("provider",),
             filters=filtered_keys,
             enclosing_key="config",
             output_format="json",
             output_file=variables_path,
-            # output_file=os.path.expanduser(config_path),
             print_data=True,
             skip_interpolation_resolving=self.himl_args.skip_interpolation_resolving,
             skip_interpolation_validation=self.himl_args.skip_interpolation_validation,
             skip_secrets=self.himl_args.skip_secrets
         )
 
-    @staticmethod
-    def execution(args, extra_args, default_output_path, composition, raw_config):
-        # Add cloud subpath for TF modules
-        terraform_composition_path = os.path.join(default_output_path, raw_config["cloud"]["type"], composition)
-        var_file = '-var-file="{}"'.format(TERRAFORM_CONFIG_FILENAME) if args.subcommand in SUBCMDS_WITH_VARS else ''
-        terraform_env_config = 'export TF_PLUGIN_CACHE_DIR="{}"'.format(local_config_dir())
+    def execution(self, args, extra_args, default_output_path, composition, raw_config):
+        var_file = []
+        if args.subcommand in SUBCMDS_WITH_VARS:
+            var_file = [f'-var-file={TERRAFORM_CONFIG_FILENAME}']
+        parallelism = parallelism_arg(args.subcommand, self.parallelism, extra_args)
+        terraform_composition_path = self.composition_paths[composition]
+
+        # Only (re-)initialize when the files terraform init depends on changed since the last run
+        pre_commands = []
+        if self.force_init or not is_initialized(terraform_composition_path):
+            if self.remove_local_cache:
+                shutil.rmtree(os.path.join(terraform_composition_path, '.terraform'),
+                              ignore_errors=True)
+            pre_commands.append(["terraform", "init", "-input=false"])
+            self.initialized_compositions.add(composition)
+        else:
+            logger.info('Skipping terraform init, %s is already initialized',
+                        terraform_composition_path)
+
+        env = dict(os.environ)
+        if self.plugin_cache_dir:
+            env['TF_PLUGIN_CACHE_DIR'] = str(self.plugin_cache_dir)
+
+        return dict(command=["terraform", args.subcommand] + parallelism + var_file + extra_args,
+                    pre_commands=pre_commands,
+                    pre_commands_lock=self.init_lock,
+                    cwd=terraform_composition_path,
+                    env=env)
+
+    def execution_post_action(self, composition):
+        if composition in self.initialized_compositions:
+            store_init_hash(self.composition_paths[composition])
+
+
+def init_hash(terraform_composition_path):
+    """
+    Return a digest of the files terraform init depends on: the terraform files (including the
+    generated provider and backend), the dependency lock file, the module manifest and the
+    terraform files of the local modules it lists. Variables are not part of it.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    update_digest(digest, terraform_composition_path,
+                  lambda name: name.endswith(('.tf', '.tf.json')) or name == '.terraform.lock.hcl')
+
+    modules_manifest = os.path.join(terraform_composition_path, '.terraform', 'modules',
+                                    'modules.json')
+    if os.path.isfile(modules_manifest):
+        with open(modules_manifest, 'rb') as f:
+            manifest = f.read()
+        digest.update(manifest)
+
+        # Local module sources are used in place, their changes are not seen in the manifest
+        for module in json.loads(manifest).get('Modules', []):
+            if module.get('Source', '').startswith(('./', '../')):
+                module_path = os.path.join(terraform_composition_path, module['Dir'])
+                if os.path.isdir(module_path):
+                    digest.update(module['Dir'].encode('utf-8'))
+                    update_digest(digest, module_path,
+                                  lambda name: name.endswith(('.tf', '.tf.json')))
+
+    return digest.hexdigest()
+
+
+def update_digest(digest, directory, include):
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if entry.is_file() and include(entry.name):
+            digest.update(entry.name.encode('utf-8'))
+            with open(entry.path, 'rb') as f:
+                digest.update(f.read())
+
+
+def is_initialized(terraform_composition_path):
+    """
+    Whether terraform init succeeded in the composition directory with the current terraform files.
+    """
+    terraform_dir = os.path.join(terraform_composition_path, '.terraform')
+    if not os.path.isdir(os.path.join(terraform_dir, 'providers')):
+        return False
+
+    try:
+        with open(os.path.join(terraform_dir, TERRAFORM_INIT_HASH_FILENAME)) as f:
+            return f.read() == init_hash(terraform_composition_path)
+    except (OSError, ValueError):
+        return False
 
-        cmd = "cd {terraform_path} && " \
-              "{remove_local_cache} " \
-              "{env_config} ; terraform init && terraform {subcommand} {var_file} {extra_args}".format(
-            terraform_path=terraform_composition_path,
-            remove_local_cache=remove_local_cache_cmd(args.subcommand),
-            subcommand=args.subcommand,
-            extra_args=' '.join(extra_args),
-            var_file=var_file,
-            env_config=terraform_env_config)
 
-        return dict(command=cmd)
+def store_init_hash(terraform_composition_path):
+    terraform_dir = os.path.join(terraform_composition_path, '.terraform')
+    if os.path.isdir(terraform_dir):
+        with open(os.path.join(terraform_dir, TERRAFORM_INIT_HASH_FILENAME), 'w') as f:
+            f.write(init_hash(terraform_composition_path))
 
 
-def remove_local_cache_cmd(subcommand):
-    if subcommand in SUBCMDS_WITH_INIT:
-        return 'rm -rf .terraform &&'
+def parallelism_arg(subcommand, parallelism, extra_args):
+    """
+    Return the -parallelism argument of the subcommand, unless one was passed as an extra argument.
+    """
+    if not parallelism or subcommand not in SUBCMDS_WITH_PARALLELISM:
+        return []
+    if any(arg.lstrip('-').startswith('parallelism') for arg in extra_args):
+        return []
 
-    return ''
+    return [f'-parallelism={parallelism}']
 
 
 def local_config_dir(directory=TERRAFORM_CACHE_DIR):
     try:
-        Path(Path.expanduser(Path(directory))).mkdir(parents=True, exist_ok=True)
-        return Path.expanduser(Path(directory))
+        path = Path(directory).expanduser()
+        path.mkdir(parents=True, exist_ok=True)
+        return path
 
     except IOError:
-        logging.error("Failed to create dir in path: %s", directory)
+        logger.error("Failed to create dir in path: %s", directory)
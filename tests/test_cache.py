@@ -0,0 +1,42 @@
+# Copyright 2019 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import os
+
+from kompos.helpers.cache import read_json_cache, write_json_cache
+
+
+def test_json_cache_round_trip(tmp_path):
+    cache_file = str(tmp_path / 'cache' / 'versions.json')
+
+    write_json_cache(cache_file, {'terraform': [1, 2, 'v1.3.0']})
+
+    assert read_json_cache(cache_file) == {'terraform': [1, 2, 'v1.3.0']}
+    assert os.listdir(tmp_path / 'cache') == ['versions.json']
+
+
+def test_disabled_or_unreadable_json_cache_is_empty(tmp_path):
+    cache_file = tmp_path / 'versions.json'
+    cache_file.write_text('not json')
+
+    write_json_cache(None, {'terraform': 'v1.3.0'})
+
+    assert read_json_cache(None) == {}
+    assert read_json_cache(str(cache_file)) == {}
+
+
+def test_failed_cache_write_is_ignored(tmp_path):
+    # The parent of the cache file is a file, the cache directory cannot be created
+    (tmp_path / 'cache').write_text('')
+    cache_file = str(tmp_path / 'cache' / 'versions.json')
+
+    write_json_cache(cache_file, {'terraform': 'v1.3.0'})
+
+    assert read_json_cache(cache_file) == {}
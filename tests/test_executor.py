@@ -0,0 +1,46 @@
+# Copyright 2019 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import sys
+
+import kompos
+from kompos import Executor, display, simple_argv
+
+
+def test_simple_command_is_split():
+    assert simple_argv('ls -la "some dir"') == ['ls', '-la', 'some dir']
+
+
+def test_shell_features_keep_the_shell():
+    assert simple_argv('cd /tmp && ls') is None
+    assert simple_argv('echo $HOME') is None
+    assert simple_argv('FOO=bar ls') is None
+
+
+def test_failing_pre_command_stops_the_execution(tmp_path):
+    marker = tmp_path / 'ran'
+    cmd = dict(command=[sys.executable, '-c', 'open("ran", "w")'],
+               pre_commands=[[sys.executable, '-c', 'raise SystemExit(3)']],
+               cwd=str(tmp_path))
+
+    assert Executor._execute(cmd) == 3
+    assert not marker.exists()
+
+
+def test_display_without_colors_prints_plain_text(monkeypatch, capsys):
+    monkeypatch.setattr(kompos, 'COLOR_ENABLED', False)
+    display('hello', color='green')
+    assert capsys.readouterr().out == 'hello\n'
+
+
+def test_display_with_colors_uses_ansi_codes(monkeypatch, capsys):
+    monkeypatch.setattr(kompos, 'COLOR_ENABLED', True)
+    display('hello', color='green')
+    assert capsys.readouterr().out == '\033[32mhello\033[0m\n'
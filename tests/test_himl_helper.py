@@ -0,0 +1,114 @@
+# Copyright 2019 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import os
+from pathlib import Path
+
+import pytest
+
+from kompos.helpers import himl_helper
+from kompos.helpers.himl_helper import HierarchicalConfigGenerator
+
+
+class FakeConfigProcessor:
+    """ Writes the name of the rendered config path and counts the renders """
+
+    def __init__(self):
+        self.renders = 0
+
+    def process(self, path, output_file, **kwargs):
+        self.renders += 1
+        with open(output_file, 'w') as f:
+            f.write(f"{path} {os.environ.get('KOMPOS_TEST_CLUSTER')}\n")
+
+
+@pytest.fixture
+def hierarchy(tmp_path, monkeypatch):
+    # Config paths are relative to the current directory, as given on the command line
+    monkeypatch.chdir(tmp_path)
+    config_path = Path('data', 'env=dev', 'composition=vpc')
+    config_path.mkdir(parents=True)
+    Path('data', 'defaults.yaml').write_text('cluster: "{{env(KOMPOS_TEST_CLUSTER)}}"\n')
+    (config_path / 'vpc.yaml').write_text('cidr: 10.0.0.0/16\n')
+    return config_path
+
+
+@pytest.fixture
+def generator(tmp_path, monkeypatch):
+    monkeypatch.setenv('KOMPOS_TEST_CLUSTER', 'dev')
+    generator = HierarchicalConfigGenerator(str(tmp_path / 'cache'))
+    generator.config_processor = FakeConfigProcessor()
+    return generator
+
+
+def new_run():
+    # The directory scans are cached for the lifetime of the process
+    himl_helper._directory_mtime.cache_clear()
+    himl_helper._directory_env_names.cache_clear()
+
+
+def generate(generator, config_path, output_file):
+    return generator.generate_config(config_path=str(config_path), output_file=str(output_file))
+
+
+def test_unchanged_hierarchy_reuses_the_cached_file(generator, hierarchy, tmp_path):
+    output_file = tmp_path / 'vars.json'
+    generate(generator, hierarchy, output_file)
+    output_file.unlink()
+
+    new_run()
+    generate(generator, hierarchy, output_file)
+
+    assert generator.config_processor.renders == 1
+    assert output_file.read_text() == f"{hierarchy} dev\n"
+
+
+def test_edited_hierarchy_is_rendered_again(generator, hierarchy, tmp_path):
+    output_file = tmp_path / 'vars.json'
+    generate(generator, hierarchy, output_file)
+
+    defaults = hierarchy.parent.parent / 'defaults.yaml'
+    defaults.write_text('cluster: other\n')
+    mtime = defaults.stat().st_mtime_ns + 10 ** 9
+    os.utime(defaults, ns=(mtime, mtime))
+
+    new_run()
+    generate(generator, hierarchy, output_file)
+
+    assert generator.config_processor.renders == 2
+
+
+def test_changed_environment_variable_is_rendered_again(generator, hierarchy, tmp_path,
+                                                        monkeypatch):
+    output_file = tmp_path / 'vars.json'
+    generate(generator, hierarchy, output_file)
+
+    monkeypatch.setenv('KOMPOS_TEST_CLUSTER', 'prod')
+    new_run()
+    generate(generator, hierarchy, output_file)
+
+    assert generator.config_processor.renders == 2
+    assert output_file.read_text() == f"{hierarchy} prod\n"
+
+
+def test_storing_an_entry_keeps_the_temporary_files_of_other_runs(generator, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    (cache_dir / 'digest-1-env.out').write_text('older hierarchy')
+    (cache_dir / 'digest-1-env.out.4242').write_text('written by another run')
+    (cache_dir / 'other-1-env.out').write_text('another config')
+    output_file = tmp_path / 'vars.json'
+    output_file.write_text('rendered')
+
+    generator.store_cached_file(str(cache_dir / 'digest-2-env'), str(output_file))
+
+    assert sorted(os.listdir(cache_dir)) == [
+        'digest-1-env.out.4242', 'digest-2-env.out', 'other-1-env.out']
+    assert (cache_dir / 'digest-2-env.out').read_text() == 'rendered'
@@ -0,0 +1,27 @@
+# Copyright 2019 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import pytest
+
+from kompos.parser import RootParser
+
+
+def test_plain_dashes_are_accepted():
+    RootParser()._check_args_for_unicode(
+        ['data/env=dev', 'helmfile', '--selector', 'chart=nginx', 'diff'])
+
+
+def test_dashes_inside_values_are_accepted():
+    RootParser()._check_args_for_unicode(['data/env=dev', 'terraform', '--var', 'desc=a — b'])
+
+
+def test_en_dash_is_rejected():
+    with pytest.raises(SystemExit):
+        RootParser()._check_args_for_unicode(['data/env=dev', 'terraform', '––skip-plan'])
@@ -0,0 +1,39 @@
+# Copyright 2019 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+import pytest
+
+from kompos.runner import composition_levels
+
+
+def test_compositions_without_needs_run_in_a_single_level():
+    levels = composition_levels(['vpc', 'cluster', 'apps'], {})
+
+    assert levels == [('vpc', 'cluster', 'apps')]
+
+
+def test_compositions_wait_for_their_needs():
+    needs = {'cluster': ['vpc'], 'apps': ['cluster'], 'dns': ['vpc']}
+
+    levels = composition_levels(['vpc', 'cluster', 'dns', 'apps'], needs)
+
+    assert levels == [('vpc',), ('cluster', 'dns'), ('apps',)]
+
+
+def test_needs_outside_of_the_run_are_ignored():
+    needs = {'cluster': ['vpc'], 'apps': ['cluster']}
+
+    assert composition_levels(['cluster', 'apps'], needs) == [('cluster',), ('apps',)]
+
+
+def test_circular_needs_are_rejected():
+    needs = {'vpc': ['apps'], 'cluster': ['vpc'], 'apps': ['cluster']}
+
+    with pytest.raises(Exception, match="Circular needs"):
+        composition_levels(['vpc', 'cluster', 'apps'], needs)
@@ -0,0 +1,108 @@
+# Copyright 2019 Adobe. All rights reserved.
+# This file is licensed to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy
+# of the License at http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software distributed under
+# the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR REPRESENTATIONS
+# OF ANY KIND, either express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+
+import json
+from argparse import Namespace
+
+import pytest
+
+from kompos.runners.terraform import TerraformRunner, is_initialized, store_init_hash
+
+
+class FakeKomposConfig:
+    def config_cache_dir(self, runner):
+        return None
+
+
+@pytest.fixture
+def composition(tmp_path):
+    composition_path = tmp_path / 'compositions' / 'vpc'
+    (composition_path / '.terraform' / 'providers').mkdir(parents=True)
+    (composition_path / 'main.tf').write_text('module "vpc" { source = "../../modules/vpc" }\n')
+    (composition_path / 'provider.tf.json').write_text('{"provider": {"aws": {}}}\n')
+    (composition_path / '.terraform.lock.hcl').write_text('provider "aws" {}\n')
+    (composition_path / 'variables.tfvars.json').write_text('{"cidr": "10.0.0.0/16"}\n')
+
+    module_path = tmp_path / 'modules' / 'vpc'
+    module_path.mkdir(parents=True)
+    (module_path / 'main.tf').write_text('resource "aws_vpc" "vpc" {}\n')
+    modules = [
+        {'Key': '', 'Source': '', 'Dir': '.'},
+        {'Key': 'vpc', 'Source': '../../modules/vpc', 'Dir': '../../modules/vpc'},
+        {'Key': 'eks', 'Source': 'terraform-aws-modules/eks/aws', 'Dir': '.terraform/modules/eks'},
+    ]
+    (composition_path / '.terraform' / 'modules').mkdir()
+    (composition_path / '.terraform' / 'modules' / 'modules.json').write_text(
+        json.dumps({'Modules': modules}))
+    return composition_path
+
+
+def test_unchanged_composition_skips_init(composition):
+    store_init_hash(str(composition))
+
+    assert is_initialized(str(composition))
+
+
+def test_not_initialized_composition_needs_init(composition):
+    assert not is_initialized(str(composition))
+
+
+@pytest.mark.parametrize('filename', ['main.tf', 'provider.tf.json', '.terraform.lock.hcl'])
+def test_edited_terraform_file_forces_init(composition, filename):
+    store_init_hash(str(composition))
+
+    with open(composition / filename, 'a') as f:
+        f.write('\n# edited\n')
+
+    assert not is_initialized(str(composition))
+
+
+def test_edited_variables_do_not_force_init(composition):
+    store_init_hash(str(composition))
+
+    (composition / 'variables.tfvars.json').write_text('{"cidr": "10.1.0.0/16"}\n')
+
+    assert is_initialized(str(composition))
+
+
+def test_edited_local_module_forces_init(composition, tmp_path):
+    store_init_hash(str(composition))
+
+    (tmp_path / 'modules' / 'vpc' / 'versions.tf').write_text('terraform {}\n')
+
+    assert not is_initialized(str(composition))
+
+
+def test_unreadable_module_manifest_forces_init(composition):
+    store_init_hash(str(composition))
+
+    (composition / '.terraform' / 'modules' / 'modules.json').write_text('not json')
+
+    assert not is_initialized(str(composition))
+
+
+@pytest.mark.parametrize('return_code, initialized', [(0, True), (1, False)])
+def test_init_hash_is_only_stored_by_successful_runs(composition, monkeypatch, return_code,
+                                                     initialized):
+    commands = []
+
+    def execute(command):
+        commands.append(command)
+        return return_code
+
+    runner = TerraformRunner(FakeKomposConfig(), None, None, execute)
+    runner.composition_paths['vpc'] = str(composition)
+    monkeypatch.setattr(runner, 'prepare_composition', lambda args, extra_args, name, path:
+                        runner.execution(args, extra_args, None, name, None))
+
+    args = Namespace(subcommand='plan')
+    assert runner.run_compositions(args, [], ['vpc'], {'vpc': None}) == return_code
+    assert commands[0]['pre_commands'] == [['terraform', 'init', '-input=false']]
+    assert is_initialized(str(composition)) == initialized